@@ -1,186 +1,309 @@
 import asyncio
+import functools
+import hashlib
+import os
 import re
-from collections import defaultdict
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import List, Tuple
 
-import nltk
-import pymorphy3
+import openai
 from aiogram import Bot, Dispatcher
 from aiogram.filters import Command
 from aiogram.types import Message
-from nltk.corpus import stopwords
-from nltk.tag import pos_tag
-from nltk.tokenize import word_tokenize
 
 from config import (
     BOT_TOKEN,
     DATETIME_FORMAT_SHORT,
     NLTK_DATA_DIR,
+    OPENAI_API_KEY,
+    OPENAI_MODEL,
+    OPENAI_TIMEOUT_SECONDS,
     SUMMARY_PERIOD_HOURS,
     TOP_NOUNS_COUNT,
     TOP_USERS_COUNT,
     logger,
 )
 from db import (
-    add_message,
+    add_messages_batch,
     clean_old_messages,
     clear_chat_messages,
-    get_messages_period,
+    close_db,
+    get_chat_stats,
+    get_top_nouns,
+    get_window_state,
     init_db,
+    iter_messages_period,
 )
 
 # Language configuration - Russian only
 LANGUAGE = "russian"
-LANGUAGE_CODE = LANGUAGE[0:3]
 
-# Set custom NLTK data directory
-nltk.data.path.insert(0, str(NLTK_DATA_DIR))
 
+@functools.lru_cache(maxsize=1)
+def _get_stopwords() -> frozenset:
+    """Load NLTK stopwords on first use, downloading the corpus if needed
 
-# Download required NLTK data
-def _download_nltk_data():
-    """Download required NLTK data if not present"""
-    try:
-        nltk.data.find("tokenizers/punkt_tab")
-    except LookupError:
-        logger.info(f"Downloading NLTK punkt tokenizer to {NLTK_DATA_DIR}...")
-        nltk.download("punkt_tab", quiet=True, download_dir=str(NLTK_DATA_DIR))
-
-    try:
-        nltk.data.find(f"taggers/averaged_perceptron_tagger_{LANGUAGE_CODE}")
-    except LookupError:
-        logger.info(f"Downloading NLTK POS tagger for {LANGUAGE} to {NLTK_DATA_DIR}...")
-        nltk.download(
-            f"averaged_perceptron_tagger_{LANGUAGE_CODE}",
-            quiet=True,
-            download_dir=str(NLTK_DATA_DIR),
-        )
+    Keeps nltk out of module import so processes that never extract
+    nouns (OpenAI-only deployments) don't pay for it.
+    """
+    import nltk
 
+    nltk.data.path.insert(0, str(NLTK_DATA_DIR))
     try:
         nltk.data.find("corpora/stopwords")
     except LookupError:
         logger.info(f"Downloading NLTK stopwords to {NLTK_DATA_DIR}...")
         nltk.download("stopwords", quiet=True, download_dir=str(NLTK_DATA_DIR))
 
+    from nltk.corpus import stopwords
 
-# Initialize NLTK data
-_download_nltk_data()
-
-# Load stopwords for the configured language
-try:
-    STOPWORDS = set(stopwords.words(LANGUAGE))
+    try:
+        words = stopwords.words(LANGUAGE)
+    except LookupError as e:
+        logger.error(f"Stopwords for {LANGUAGE} not found in NLTK: {e}")
+        raise ValueError(
+            f"Stopwords for language '{LANGUAGE}' are not available in NLTK. Please install the required NLTK data or use a supported language."
+        )
     logger.info(f"Loaded NLTK stopwords for language: {LANGUAGE}")
-except LookupError as e:
-    logger.error(f"Stopwords for {LANGUAGE} not found in NLTK: {e}")
-    raise ValueError(
-        f"Stopwords for language '{LANGUAGE}' are not available in NLTK. Please install the required NLTK data or use a supported language."
-    )
+    return frozenset(words)
+
 
 # Initialize bot and dispatcher
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
-morph = pymorphy3.MorphAnalyzer()
 
+# pymorphy3 loads its dictionaries lazily on first use: deployments that only
+# use OpenAI summarization never pay the import or the analyzer's memory
+_morph = None
 
-def extract_nouns(text: str) -> List[str]:
-    """Extract nouns from text using NLTK"""
-    # Skip media messages
-    if text == "[Медиа сообщение]":
-        return []
 
-    # Remove URLs and mentions
-    text = re.sub(r"http\S+|www\.\S+", "", text)
-    text = re.sub(r"@\w+", "", text)
-
-    # Use NLTK for POS tagging with configured language
-    tokens = word_tokenize(text.lower(), language=LANGUAGE)
-    tagged = pos_tag(tokens, lang=LANGUAGE[0:3])
-
-    # Extract nouns
-    nouns = [
-        morph.parse(word)[0].normal_form
-        for word, pos in tagged
-        if pos == "S" and len(word) > 2 and word not in STOPWORDS
-    ]
+def _get_morph():
+    """Build the pymorphy3 analyzer on first use and keep it resident"""
+    global _morph
+    if _morph is None:
+        import pymorphy3
 
-    return nouns
+        _morph = pymorphy3.MorphAnalyzer()
+    return _morph
 
 
-def get_top_nouns(messages: List[tuple]) -> List[tuple]:
-    """Get top N most used nouns from messages"""
-    noun_counts = defaultdict(int)
+# Async OpenAI client so LLM requests don't block the event loop
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
 
-    for _, _, _, text in messages:
-        nouns = extract_nouns(text)
-        for noun in nouns:
-            noun_counts[noun] += 1
+# Summary cache: chat_id -> (message window fingerprint, summary, expiry time)
+SUMMARY_CACHE_TTL_SECONDS = 300
+_summary_cache: dict[int, tuple[str, str, float]] = {}
 
-    # Sort by count and return top N
-    top_nouns = sorted(noun_counts.items(), key=lambda x: x[1], reverse=True)[
-        :TOP_NOUNS_COUNT
-    ]
-    return top_nouns
 
+# Resolved user handles: (chat_id, user_id) -> (handle, expiry time)
+USER_CACHE_TTL_SECONDS = 3600
+_user_cache: dict[tuple[int, int], tuple[str, float]] = {}
 
-async def summarize_basic(
-    chat_id: int, messages: List[tuple], period_hours: int
-) -> str:
-    """Basic summarization without OpenAI API"""
-    if not messages:
-        return f"Сообщений за последние {period_hours}ч не найдено."
 
-    total_messages = len(messages)
-    unique_users = len(set(msg[1] for msg in messages))
+async def _resolve_user(chat_id: int, user_id: int) -> str:
+    """Resolve a user's display handle via the Telegram API, with a TTL cache"""
+    key = (chat_id, user_id)
+    cached = _user_cache.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    user = (await bot.get_chat_member(chat_id=chat_id, user_id=user_id)).user
+    if user.username:
+        username = f"@{user.username}"
+    else:
+        username = f"tg://user?id={user_id}"
+    _user_cache[key] = (username, time.monotonic() + USER_CACHE_TTL_SECONDS)
+    return username
+
 
-    # Count messages per user
-    user_counts = defaultdict(int)
-    for _, user_id, _, _ in messages:
-        user_counts[user_id] += 1
+def _window_fingerprint(count: int, last_id: int) -> str:
+    """Fingerprint of a message window, for detecting unchanged summaries"""
+    return hashlib.blake2b(f"{count}|{last_id}".encode(), digest_size=8).hexdigest()
 
-    # Get top N most active users
-    top_users = sorted(user_counts.items(), key=lambda x: x[1], reverse=True)[
-        :TOP_USERS_COUNT
+
+# Precompiled patterns for the per-message extraction hot path; URLs and
+# mentions are stripped in one alternation so the text is scanned once
+_CLEAN_RE = re.compile(r"http\S+|www\.\S+|@\w+")
+_TOKEN_RE = re.compile(r"[а-яё]{3,}")
+_HAS_CYR = re.compile(r"[а-яёА-ЯЁ]{3,}")
+
+
+@functools.lru_cache(maxsize=131072)
+def _lemma(word: str) -> str | None:
+    """Return the normal form of a word if it is a noun, otherwise None
+
+    Chat vocabulary is heavily Zipfian, so caching collapses most
+    pymorphy3 parses to a dict lookup.
+    """
+    parsed = _get_morph().parse(word)[0]
+    return parsed.normal_form if "NOUN" in parsed.tag else None
+
+
+@functools.lru_cache(maxsize=8192)
+def extract_nouns(text: str) -> Tuple[str, ...]:
+    """Extract nouns from text using pymorphy3
+
+    Pure in text, so results are memoized: repeated messages (greetings,
+    forwards, short replies) skip tokenization entirely.
+    """
+    # Skip media messages
+    if text == "[Медиа сообщение]":
+        return ()
+
+    # Fast reject for emoji-only / non-Russian texts: one search instead
+    # of cleanup, tokenization and cache churn
+    if not _HAS_CYR.search(text):
+        return ()
+
+    # Remove URLs and mentions
+    text = _CLEAN_RE.sub("", text)
+
+    # Tokenize with a simple regex; pymorphy3 provides the POS tags,
+    # so the NLTK tokenizer + perceptron tagger pass is unnecessary
+    tokens = _TOKEN_RE.findall(text.lower())
+
+    # Extract nouns; bind the lookups once so the token loop does
+    # LOAD_FAST instead of LOAD_GLOBAL per word
+    stop = _get_stopwords()
+    lemma_of = _lemma
+    return tuple(
+        lemma for word in tokens if word not in stop and (lemma := lemma_of(word))
+    )
+
+
+# Worker pool for CPU-bound noun extraction; pymorphy3 is pure Python, so
+# processes (not threads) are needed to get real parallelism past the GIL
+EXTRACT_WORKERS = os.cpu_count() or 1
+_extract_pool: ProcessPoolExecutor | None = None
+
+
+def _extract_noun_rows(batch: List[tuple]) -> List[Tuple[int, int, str]]:
+    """Build (chat_id, ts, noun) rows for a message batch
+
+    Runs in a worker process so ingest-time extraction stays off the
+    event loop.
+    """
+    return [
+        (chat_id, ts, noun)
+        for chat_id, _, _, text, ts in batch
+        for noun in extract_nouns(text)
     ]
 
-    # Group messages by hour
-    hourly_counts = defaultdict(int)
-    for timestamp, _, _, _ in messages:
-        hour = timestamp.replace(minute=0, second=0, microsecond=0)
-        hourly_counts[hour] += 1
 
-    # Get most active hour
-    most_active_hour = (
-        max(hourly_counts.items(), key=lambda x: x[1])[0] if hourly_counts else None
+async def summarize_basic(chat_id: int, period_hours: int) -> str:
+    """Basic summarization without OpenAI API"""
+    # Message/user/hour stats come from the rolling aggregates maintained at
+    # ingest time, aggregated in SQL; only noun extraction touches the window
+    total_messages, unique_users, top_users, most_active_hour = await get_chat_stats(
+        chat_id, period_hours, TOP_USERS_COUNT
     )
 
-    # Get top nouns
-    top_nouns = get_top_nouns(messages)
+    if not total_messages:
+        return f"Сообщений за последние {period_hours}ч не найдено."
 
-    summary = f"📊 Сводка за последние {period_hours}ч:\n\n"
-    summary += f"• Всего сообщений: {total_messages}\n"
-    summary += f"• Активных пользователей: {unique_users}\n"
+    # Top nouns come from the noun table materialized at ingest time, so
+    # the query path does no tokenization at all
+    top_nouns = await get_top_nouns(chat_id, period_hours, TOP_NOUNS_COUNT)
 
-    # Add top N most active users
+    parts = [
+        f"📊 Сводка за последние {period_hours}ч:\n\n",
+        f"• Всего сообщений: {total_messages}\n",
+        f"• Активных пользователей: {unique_users}\n",
+    ]
+
+    # Add top N most active users (resolved concurrently, not one by one)
     if top_users:
-        summary += f"\n👥 Топ {TOP_USERS_COUNT} самых активных пользователей (пользователь: кол-во сообщений):\n"
-        for i, (user_id, count) in enumerate(top_users, 1):
-            user = (await bot.get_chat_member(chat_id=chat_id, user_id=user_id)).user
-            if user.username:
-                username = f"@{user.username}"
-            else:
-                username = f"tg://user?id={user_id}"
-            summary += f"  {i}. {username}: {count}\n"
+        usernames = await asyncio.gather(
+            *(_resolve_user(chat_id, user_id) for user_id, _ in top_users)
+        )
+        parts.append(
+            f"\n👥 Топ {TOP_USERS_COUNT} самых активных пользователей (пользователь: кол-во сообщений):\n"
+        )
+        for i, ((_, count), username) in enumerate(zip(top_users, usernames), 1):
+            parts.append(f"  {i}. {username}: {count}\n")
 
     # Add top nouns
     if top_nouns:
-        summary += f"\n📝 Топ {TOP_NOUNS_COUNT} самых используемых существительных (кол-во раз):\n"
+        parts.append(
+            f"\n📝 Топ {TOP_NOUNS_COUNT} самых используемых существительных (кол-во раз):\n"
+        )
         for i, (noun, count) in enumerate(top_nouns, 1):
-            summary += f"  {i}. {noun}: {count}\n"
+            parts.append(f"  {i}. {noun}: {count}\n")
 
     if most_active_hour:
-        summary += f"\n• Самый активный час: {most_active_hour.strftime(DATETIME_FORMAT_SHORT)}\n"
+        hour_start = datetime.fromtimestamp(most_active_hour * 3600)
+        parts.append(
+            f"\n• Самый активный час: {hour_start.strftime(DATETIME_FORMAT_SHORT)}\n"
+        )
 
+    return "".join(parts)
+
+
+# Debounce interval for progress edits, well under Telegram's rate limits
+OPENAI_EDIT_INTERVAL = 1.0  # seconds
+
+
+async def summarize_with_openai(
+    chat_id: int, period_hours: int, processing_msg: Message
+) -> str:
+    """Summarize messages using the OpenAI API, streaming into the reply
+
+    The completion is streamed and processing_msg is edited roughly once
+    a second, so the user watches the summary appear instead of staring
+    at a placeholder for the full generation time.
+    """
+    text_block = "\n".join(
+        [text async for _, _, _, text in iter_messages_period(chat_id, period_hours)]
+    )
+
+    last_sent = ""
+    try:
+        # The timeout covers consuming the stream too, not just opening it,
+        # so a stalled stream cannot hang the handler indefinitely
+        async with asyncio.timeout(OPENAI_TIMEOUT_SECONDS):
+            stream = await openai_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": (
+                            "Ты помощник, который кратко суммирует переписку в Telegram-чате. "
+                            "Отвечай на русском языке."
+                        ),
+                    },
+                    {
+                        "role": "user",
+                        "content": f"Составь краткую сводку этих сообщений за последние {period_hours}ч:\n\n{text_block}",
+                    },
+                ],
+                stream=True,
+            )
+
+            parts = []
+            last_edit = time.monotonic()
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content or ""
+                if delta:
+                    parts.append(delta)
+                now = time.monotonic()
+                if parts and now - last_edit > OPENAI_EDIT_INTERVAL:
+                    # A failed progress edit must not discard the summary
+                    try:
+                        await processing_msg.edit_text("".join(parts))
+                        last_sent = "".join(parts)
+                    except Exception as e:
+                        logger.warning(f"Progress edit failed, continuing: {e}")
+                    last_edit = now
+
+        summary = "".join(parts)
+    except Exception as e:
+        logger.error(f"OpenAI summarization failed, falling back to basic: {e}")
+        summary = await summarize_basic(chat_id, period_hours)
+
+    if summary != last_sent:
+        await processing_msg.edit_text(summary)
     return summary
 
 
@@ -195,25 +318,71 @@ async def cmd_help(message: Message):
     )
 
 
+# In-flight /summary computations: concurrent requests for the same chat
+# await the first one's result instead of recomputing
+_inflight: dict[int, asyncio.Future] = {}
+
+
+async def _generate_summary(message: Message) -> str:
+    """Run the summary pipeline for a chat, returning the text that was sent"""
+    chat_id = message.chat.id
+
+    # Check whether the window has any messages without fetching them
+    total_messages, last_id = await get_window_state(chat_id, SUMMARY_PERIOD_HOURS)
+
+    if not total_messages:
+        not_found = f"Сообщений за последние {SUMMARY_PERIOD_HOURS}ч не найдено."
+        await message.answer(not_found)
+        return not_found
+
+    # Serve the cached summary if the message window hasn't changed
+    fingerprint = _window_fingerprint(total_messages, last_id)
+    cached = _summary_cache.get(chat_id)
+    if cached and cached[0] == fingerprint and cached[2] > time.monotonic():
+        await message.answer(cached[1])
+        return cached[1]
+
+    # Generate and send summary
+    if openai_client:
+        processing_msg = await message.answer("⏳ Генерирую сводку...")
+        summary = await summarize_with_openai(
+            chat_id, SUMMARY_PERIOD_HOURS, processing_msg
+        )
+    else:
+        summary = await summarize_basic(chat_id, SUMMARY_PERIOD_HOURS)
+        await message.answer(summary)
+
+    _summary_cache[chat_id] = (
+        fingerprint,
+        summary,
+        time.monotonic() + SUMMARY_CACHE_TTL_SECONDS,
+    )
+    return summary
+
+
 @dp.message(Command("summary"))
 async def cmd_summary(message: Message):
     """Handle /summary command"""
     chat_id = message.chat.id
 
-    # Get messages from configured period
-    messages = await get_messages_period(chat_id, SUMMARY_PERIOD_HOURS)
-
-    if not messages:
-        await message.answer(
-            f"Сообщений за последние {SUMMARY_PERIOD_HOURS}ч не найдено."
-        )
+    # Single-flight per chat: followers wait for the leader's summary
+    fut = _inflight.get(chat_id)
+    if fut is not None:
+        await message.answer(await fut)
         return
 
-    # Generate summary
-    summary = await summarize_basic(chat_id, messages, SUMMARY_PERIOD_HOURS)
-
-    # Send summary
-    await message.answer(summary)
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[chat_id] = fut
+    try:
+        summary = await _generate_summary(message)
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved in case no follower is waiting
+        raise
+    else:
+        fut.set_result(summary)
+    finally:
+        _inflight.pop(chat_id, None)
 
 
 @dp.message(Command("clear"))
@@ -246,34 +415,99 @@ async def handle_message(message: Message):
     chat_id = message.chat.id
     user_id = message.from_user.id if message.from_user else None
     text = message.text or message.caption or "[Медиа сообщение]"
-    timestamp = datetime.now()
+    timestamp = int(time.time())
+
+    # Queue message for the batched database writer
+    _insert_queue.put_nowait((chat_id, user_id, message.message_id, text, timestamp))
 
-    # Store message in database
-    await add_message(chat_id, user_id, message.message_id, text, timestamp)
+    logger.debug(f"Queued message from {user_id} in chat {chat_id}")
 
-    logger.debug(f"Stored message from {user_id} in chat {chat_id}")
+
+# Batched message writer: one INSERT + commit per incoming message saturates
+# the database under bursty load, so inserts are queued and flushed in batches
+INSERT_FLUSH_INTERVAL = 0.5  # seconds
+INSERT_FLUSH_BATCH_SIZE = 200
+_insert_queue: asyncio.Queue = asyncio.Queue()
+
+
+async def _message_flusher():
+    """Drain queued messages into the database in batches"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _insert_queue.get()]
+        deadline = loop.time() + INSERT_FLUSH_INTERVAL
+        while len(batch) < INSERT_FLUSH_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_insert_queue.get(), timeout))
+            except TimeoutError:
+                break
+
+        # Extract nouns for the batch off the event loop, then write
+        # messages and nouns in one transaction. A failed flush must not
+        # kill the task: log and drop the batch, then keep draining
+        try:
+            if _extract_pool is not None:
+                noun_rows = await loop.run_in_executor(
+                    _extract_pool, _extract_noun_rows, batch
+                )
+            else:
+                noun_rows = _extract_noun_rows(batch)
+            await add_messages_batch(batch, noun_rows)
+        except Exception as e:
+            logger.error(
+                f"Failed to flush batch of {len(batch)} messages, dropping: {e}"
+            )
+
+
+# Cleanup cadence bounds (seconds): back off when idle, speed up when busy
+CLEANUP_BASE_INTERVAL = 3600
+CLEANUP_MIN_INTERVAL = 300
+CLEANUP_MAX_INTERVAL = 21600
+CLEANUP_BUSY_THRESHOLD = 10000  # deletions per run
 
 
 async def periodic_cleanup():
-    """Periodically clean old messages"""
+    """Periodically clean old messages, adapting the cadence to deletions"""
+    interval = CLEANUP_BASE_INTERVAL
     while True:
-        await asyncio.sleep(3600)  # Run every hour
-        await clean_old_messages(SUMMARY_PERIOD_HOURS)
-        logger.info("Periodic cleanup completed")
+        await asyncio.sleep(interval)
+        deleted = await clean_old_messages(SUMMARY_PERIOD_HOURS)
+        if deleted == 0:
+            interval = min(interval * 2, CLEANUP_MAX_INTERVAL)
+        elif deleted > CLEANUP_BUSY_THRESHOLD:
+            interval = max(interval // 2, CLEANUP_MIN_INTERVAL)
+        else:
+            interval = CLEANUP_BASE_INTERVAL
+        logger.info(f"Periodic cleanup completed, next run in {interval}s")
 
 
 async def main():
     """Main function to start the bot"""
+    global _extract_pool
     logger.info("Starting bot...")
 
     # Initialize database
     await init_db()
 
-    # Start periodic cleanup task
-    asyncio.create_task(periodic_cleanup())
+    # Worker pool for CPU-bound summarization work
+    _extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+
+    # Start background tasks (references kept so they are not garbage collected)
+    background_tasks = [
+        asyncio.create_task(_message_flusher()),
+        asyncio.create_task(periodic_cleanup()),
+    ]
 
     # Start polling
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await close_db()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import functools
 import logging
 from os import getenv
 from pathlib import Path
@@ -7,21 +8,33 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+
+@functools.cache
+def _env(name: str, default: str = "", cast=str):
+    """Read an environment variable once, applying an optional cast"""
+    return cast(getenv(name, default))
+
+
 # Environment variables
 BOT_TOKEN = getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is required")
-DB_PATH = Path(getenv("DB_PATH", "messages.db"))
-LOG_LEVEL = getenv("LOG_LEVEL", logging.INFO)
+DB_PATH = _env("DB_PATH", "messages.db", Path)
+LOG_LEVEL = _env("LOG_LEVEL", "INFO")
+
+# OpenAI summarization (optional - falls back to basic summary when unset)
+OPENAI_API_KEY = getenv("OPENAI_API_KEY")
+OPENAI_MODEL = _env("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_TIMEOUT_SECONDS = _env("OPENAI_TIMEOUT_SECONDS", "30", int)
 
-DATETIME_FORMAT = getenv("DATETIME_FORMAT", "%d.%m.%Y %H:%M:%S")  # unused at the moment
-DATETIME_FORMAT_SHORT = getenv("DATETIME_FORMAT_SHORT", "%d.%m.%Y %H:%M")
-TOP_USERS_COUNT = int(getenv("TOP_USERS_COUNT", "3"))
-TOP_NOUNS_COUNT = int(getenv("TOP_NOUNS_COUNT", "5"))
-SUMMARY_PERIOD_HOURS = int(getenv("SUMMARY_PERIOD_HOURS", "24"))
+DATETIME_FORMAT = _env("DATETIME_FORMAT", "%d.%m.%Y %H:%M:%S")  # unused at the moment
+DATETIME_FORMAT_SHORT = _env("DATETIME_FORMAT_SHORT", "%d.%m.%Y %H:%M")
+TOP_USERS_COUNT = _env("TOP_USERS_COUNT", "3", int)
+TOP_NOUNS_COUNT = _env("TOP_NOUNS_COUNT", "5", int)
+SUMMARY_PERIOD_HOURS = _env("SUMMARY_PERIOD_HOURS", "24", int)
 
-# NLTK data directory
-NLTK_DATA_DIR = Path(getenv("NLTK_DATA_DIR", "nltk_data")).resolve()
+# NLTK data directory (resolved and created exactly once, at first import)
+NLTK_DATA_DIR = _env("NLTK_DATA_DIR", "nltk_data", Path).resolve()
 NLTK_DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 # Configure logging
@@ -1,107 +1,324 @@
+import asyncio
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import List, Optional, Tuple
+from typing import AsyncIterator, List, Optional, Tuple
 
 import aiosqlite
 
 from config import DB_PATH, logger
 
+# Single long-lived connection shared by all handlers; opened in init_db().
+# Reconnecting per call pays connection setup and a full fsync per write.
+_conn: Optional[aiosqlite.Connection] = None
+
+_PRAGMAS = """
+    PRAGMA auto_vacuum=INCREMENTAL;
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+"""
+
+
+def _hour_bucket(ts: int) -> int:
+    """Epoch-hour bucket used by the rolling per-chat aggregates"""
+    return ts // 3600
+
+
+def _cutoff_ts(hours: int) -> int:
+    """Epoch-second cutoff for a trailing window of N hours"""
+    return int((datetime.now() - timedelta(hours=hours)).timestamp())
+
+
+def _db() -> aiosqlite.Connection:
+    """Return the shared connection opened by init_db"""
+    if _conn is None:
+        raise RuntimeError("Database not initialized - call init_db() first")
+    return _conn
+
 
 async def init_db():
-    """Initialize the database and create tables if they don't exist"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER,
-                message_id INTEGER NOT NULL,
-                text TEXT NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        """)
-        await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_chat_timestamp
-            ON messages(chat_id, timestamp)
-        """)
-        await db.commit()
-        logger.info("Database initialized")
+    """Open the shared connection and create tables if they don't exist"""
+    global _conn
+    _conn = await aiosqlite.connect(DB_PATH)
+    await _conn.executescript(_PRAGMAS)
+
+    # Databases from before the epoch-integer switch declared the timestamp
+    # column TEXT; in-place updates keep TEXT affinity (and make integer range
+    # predicates compare as strings), so rebuild the table instead
+    async with _conn.execute(
+        "SELECT type FROM pragma_table_info('messages') WHERE name = 'timestamp'"
+    ) as cursor:
+        row = await cursor.fetchone()
+    legacy_messages = row is not None and row[0] == "TEXT"
+    if legacy_messages:
+        await _conn.execute("ALTER TABLE messages RENAME TO messages_legacy")
+
+    await _conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER,
+            message_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        )
+    """)
+
+    if legacy_messages:
+        # 'utc' because the legacy rows were written as local-time isoformat
+        cursor = await _conn.execute(
+            "INSERT INTO messages (id, chat_id, user_id, message_id, text, timestamp) "
+            "SELECT id, chat_id, user_id, message_id, text, "
+            "CAST(strftime('%s', timestamp, 'utc') AS INTEGER) FROM messages_legacy"
+        )
+        # Dropping the legacy table also frees its index names for re-creation
+        await _conn.execute("DROP TABLE messages_legacy")
+        logger.info(f"Migrated {cursor.rowcount} text timestamps to epoch seconds")
+
+    await _conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_timestamp
+        ON messages(chat_id, timestamp)
+    """)
+    await _conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_timestamp
+        ON messages(timestamp)
+    """)
+    await _conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_nouns (
+            chat_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            noun TEXT NOT NULL
+        )
+    """)
+    await _conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_nouns_chat_ts
+        ON message_nouns(chat_id, ts)
+    """)
+    await _conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_nouns_ts
+        ON message_nouns(ts)
+    """)
+    await _conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_hourly_stats (
+            chat_id INTEGER NOT NULL,
+            hour_bucket INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, hour_bucket, user_id)
+        )
+    """)
+    # Backfill the rolling aggregates from whatever messages already exist
+    async with _conn.execute(
+        "SELECT EXISTS(SELECT 1 FROM chat_hourly_stats)"
+    ) as cursor:
+        has_stats = (await cursor.fetchone())[0]
+    if not has_stats:
+        await _conn.execute(
+            "INSERT INTO chat_hourly_stats (chat_id, hour_bucket, user_id, message_count) "
+            "SELECT chat_id, timestamp / 3600, user_id, COUNT(*) FROM messages "
+            "WHERE user_id IS NOT NULL "
+            "GROUP BY chat_id, timestamp / 3600, user_id"
+        )
+
+    await _conn.commit()
+    # Let sqlite refresh its query-planner statistics
+    await _conn.execute("PRAGMA optimize")
+    logger.info("Database initialized")
+
+
+async def close_db():
+    """Close the shared connection so WAL contents checkpoint on shutdown"""
+    global _conn
+    if _conn is not None:
+        # Recommended before closing long-lived connections
+        await _conn.execute("PRAGMA optimize")
+        await _conn.close()
+        _conn = None
 
 
-async def add_message(
-    chat_id: int,
-    user_id: int,
-    message_id: int,
-    text: str,
-    timestamp: Optional[datetime] = None,
+async def _bump_hourly_stats(
+    db: aiosqlite.Connection, increments: List[Tuple[int, int, int, int]]
 ):
-    """Add a message to the database"""
-    if timestamp is None:
-        timestamp = datetime.now()
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO messages (chat_id, timestamp, user_id, message_id, text) VALUES (?, ?, ?, ?, ?)",
-            (chat_id, timestamp.isoformat(), user_id, message_id, text),
+    """Apply (chat_id, hour_bucket, user_id, count) increments to the aggregates"""
+    await db.executemany(
+        "INSERT INTO chat_hourly_stats (chat_id, hour_bucket, user_id, message_count) "
+        "VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(chat_id, hour_bucket, user_id) "
+        "DO UPDATE SET message_count = message_count + excluded.message_count",
+        increments,
+    )
+
+
+async def add_messages_batch(
+    rows: List[Tuple[int, int, int, str, int]],
+    noun_rows: Optional[List[Tuple[int, int, str]]] = None,
+):
+    """Insert a batch of messages (and their extracted nouns) in one transaction
+
+    Rows carry epoch-second timestamps, stored as-is. noun_rows are
+    (chat_id, ts, noun) tuples precomputed by the caller at ingest time.
+    """
+    db = _db()
+    await db.executemany(
+        "INSERT INTO messages (chat_id, user_id, message_id, text, timestamp) VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
+    if noun_rows:
+        await db.executemany(
+            "INSERT INTO message_nouns (chat_id, ts, noun) VALUES (?, ?, ?)",
+            noun_rows,
         )
-        await db.commit()
+
+    # Keep the rolling aggregates in step with the batch; user_id is
+    # NOT NULL in chat_hourly_stats, so anonymous messages are skipped
+    increments = Counter()
+    for chat_id, user_id, _, _, ts in rows:
+        if user_id is None:
+            continue
+        increments[(chat_id, _hour_bucket(ts), user_id)] += 1
+    await _bump_hourly_stats(db, [(c, h, u, n) for (c, h, u), n in increments.items()])
+    await db.commit()
 
 
-async def get_messages_period(
+async def iter_messages_period(
     chat_id: int, hours: int
-) -> List[Tuple[datetime, str, str]]:
-    """Get all messages from the last N hours for a chat"""
-    cutoff_time = datetime.now() - timedelta(hours=hours)
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT timestamp, user_id, message_id, text FROM messages WHERE chat_id = ? AND timestamp > ? ORDER BY timestamp",
-            (chat_id, cutoff_time.isoformat()),
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [
-                (
-                    datetime.fromisoformat(row["timestamp"]),
-                    row["user_id"],
-                    row["message_id"],
-                    row["text"],
-                )
-                for row in rows
-            ]
-
-
-async def clean_old_messages(hours: int):
-    """Remove messages older than N hours from storage"""
-    cutoff_time = datetime.now() - timedelta(hours=hours)
-
-    async with aiosqlite.connect(DB_PATH) as db:
+) -> AsyncIterator[Tuple[int, int, int, str]]:
+    """Iterate over messages from the last N hours for a chat
+
+    Yields rows lazily so callers can aggregate without materializing the
+    whole window in memory. Timestamps are epoch seconds; callers convert
+    to datetime only where a formatted value is needed.
+    """
+    cutoff_ts = _cutoff_ts(hours)
+
+    async with _db().execute(
+        "SELECT timestamp, user_id, message_id, text FROM messages WHERE chat_id = ? AND timestamp > ? ORDER BY timestamp",
+        (chat_id, cutoff_ts),
+    ) as cursor:
+        async for row in cursor:
+            yield (row[0], row[1], row[2], row[3])
+
+
+async def get_window_state(chat_id: int, hours: int) -> Tuple[int, Optional[int]]:
+    """Get (message count, last row id) for a chat's recent window"""
+    async with _db().execute(
+        "SELECT COUNT(*), MAX(id) FROM messages WHERE chat_id = ? AND timestamp > ?",
+        (chat_id, _cutoff_ts(hours)),
+    ) as cursor:
+        row = await cursor.fetchone()
+        return (row[0], row[1])
+
+
+async def get_chat_stats(
+    chat_id: int, hours: int, top_users_count: int
+) -> Tuple[int, int, List[Tuple[int, int]], Optional[int]]:
+    """Read the rolling aggregates for a chat's recent window
+
+    Returns (total messages, unique users, top users, busiest hour
+    bucket), all aggregated in SQL so only O(top_users_count) rows cross
+    into Python.
+    """
+    cutoff_bucket = _hour_bucket(_cutoff_ts(hours))
+
+    async with _db().execute(
+        "SELECT COALESCE(SUM(message_count), 0), COUNT(DISTINCT user_id) "
+        "FROM chat_hourly_stats WHERE chat_id = ? AND hour_bucket >= ?",
+        (chat_id, cutoff_bucket),
+    ) as cursor:
+        total_messages, unique_users = await cursor.fetchone()
+
+    async with _db().execute(
+        "SELECT user_id, SUM(message_count) AS c FROM chat_hourly_stats "
+        "WHERE chat_id = ? AND hour_bucket >= ? "
+        "GROUP BY user_id ORDER BY c DESC LIMIT ?",
+        (chat_id, cutoff_bucket, top_users_count),
+    ) as cursor:
+        top_users = [(row[0], row[1]) for row in await cursor.fetchall()]
+
+    async with _db().execute(
+        "SELECT hour_bucket FROM chat_hourly_stats "
+        "WHERE chat_id = ? AND hour_bucket >= ? "
+        "GROUP BY hour_bucket ORDER BY SUM(message_count) DESC LIMIT 1",
+        (chat_id, cutoff_bucket),
+    ) as cursor:
+        row = await cursor.fetchone()
+        most_active_bucket = row[0] if row else None
+
+    return total_messages, unique_users, top_users, most_active_bucket
+
+
+async def get_top_nouns(chat_id: int, hours: int, limit: int) -> List[Tuple[str, int]]:
+    """Top nouns for a chat's recent window from the materialized noun table"""
+    async with _db().execute(
+        "SELECT noun, COUNT(*) AS c FROM message_nouns "
+        "WHERE chat_id = ? AND ts > ? GROUP BY noun ORDER BY c DESC LIMIT ?",
+        (chat_id, _cutoff_ts(hours), limit),
+    ) as cursor:
+        return [(row[0], row[1]) for row in await cursor.fetchall()]
+
+
+CLEANUP_BATCH_SIZE = 5000
+
+
+async def clean_old_messages(hours: int) -> int:
+    """Remove messages older than N hours from storage, returning the count
+
+    Deletes in bounded batches so large backlogs don't hold the write
+    lock for the whole cleanup.
+    """
+    cutoff_ts = _cutoff_ts(hours)
+    deleted_count = 0
+
+    db = _db()
+    while True:
         cursor = await db.execute(
-            "DELETE FROM messages WHERE timestamp < ?", (cutoff_time.isoformat(),)
+            "DELETE FROM messages WHERE rowid IN "
+            "(SELECT rowid FROM messages WHERE timestamp < ? LIMIT ?)",
+            (cutoff_ts, CLEANUP_BATCH_SIZE),
         )
-        deleted_count = cursor.rowcount
         await db.commit()
-        if deleted_count > 0:
-            logger.info(f"Cleaned {deleted_count} old messages from database")
+        if cursor.rowcount <= 0:
+            break
+        deleted_count += cursor.rowcount
+        # Let the event loop serve other work between batches
+        await asyncio.sleep(0)
 
-
-async def clear_chat_messages(chat_id: int):
-    """Clear all messages for a specific chat"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-        deleted_count = cursor.rowcount
+    # Evict materialized nouns for the same range, also in bounded batches
+    while True:
+        cursor = await db.execute(
+            "DELETE FROM message_nouns WHERE rowid IN "
+            "(SELECT rowid FROM message_nouns WHERE ts < ? LIMIT ?)",
+            (cutoff_ts, CLEANUP_BATCH_SIZE),
+        )
         await db.commit()
-        logger.info(f"Cleared {deleted_count} messages for chat {chat_id}")
-        return deleted_count
+        if cursor.rowcount <= 0:
+            break
+        await asyncio.sleep(0)
+
+    # Evict aggregate buckets that aged out of the window
+    await db.execute(
+        "DELETE FROM chat_hourly_stats WHERE hour_bucket < ?",
+        (_hour_bucket(cutoff_ts),),
+    )
+    await db.commit()
 
+    if deleted_count > 0:
+        # Return freed pages to the filesystem a little at a time
+        await db.execute("PRAGMA incremental_vacuum(1000)")
+        await db.commit()
+        logger.info(f"Cleaned {deleted_count} old messages from database")
+    return deleted_count
 
-async def get_message_count(chat_id: int, hours: int) -> int:
-    """Get the count of messages for a chat in the last N hours"""
-    cutoff_time = datetime.now() - timedelta(hours=hours)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT COUNT(*) as count FROM messages WHERE chat_id = ? AND timestamp > ?",
-            (chat_id, cutoff_time.isoformat()),
-        ) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else 0
+async def clear_chat_messages(chat_id: int):
+    """Clear all messages for a specific chat"""
+    db = _db()
+    cursor = await db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+    deleted_count = cursor.rowcount
+    await db.execute("DELETE FROM message_nouns WHERE chat_id = ?", (chat_id,))
+    await db.execute("DELETE FROM chat_hourly_stats WHERE chat_id = ?", (chat_id,))
+    await db.commit()
+    logger.info(f"Cleared {deleted_count} messages for chat {chat_id}")
+    return deleted_count